@@ -1,13 +1,23 @@
 import streamlit as st
 import os
+import hashlib
 import zipfile
-import tempfile
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+from pathlib import PurePosixPath
+import numpy as np
 from PIL import Image
 from io import BytesIO
 import time
 import base64
 
+try:
+    import pyvips  # Optional: faster WebP encoding through libvips
+except (ImportError, OSError):
+    pyvips = None
+
 # Set page config for better appearance
 st.set_page_config(
     page_title="Smart Image Compressor",
@@ -23,25 +33,287 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def compress_image(img, target_kb):
-    quality = 90
-    step = 5
-    while quality > 10:
-        buffer = BytesIO()
-        img.save(buffer, format="WEBP", quality=quality)
+IMAGE_EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg', '.webp'))
+
+MIN_QUALITY = 10
+MAX_QUALITY = 90
+QUALITY_STEP = 5
+
+# Rough guess at WebP output for photographic content at the lowest quality.
+# Images with more pixels than the target holds at this rate get a real
+# lowest-quality encode at full size first, and are only shrunk to this
+# density if that misses the target: flat graphics and screenshots often
+# fit far below it.
+MIN_BYTES_PER_PIXEL = 0.02
+
+def max_dimensions(size, target_kb):
+    width, height = size
+    max_pixels = target_kb * 1024 / MIN_BYTES_PER_PIXEL
+    if width * height <= max_pixels:
+        return None
+    scale = (max_pixels / (width * height)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def flatten_alpha(img):
+    # Composite onto a white background in one vectorized pass. Integer math
+    # is enough: c * a + 255 * (255 - a) never exceeds 255 * 255.
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    pixels = np.asarray(img, dtype=np.uint16)
+    rgb, alpha = pixels[..., :3], pixels[..., 3:]
+    flat = (rgb * alpha + 255 * (255 - alpha) + 127) // 255
+    return Image.fromarray(flat.astype(np.uint8))
+
+def search_quality(encode, target_kb, curve):
+    min_quality = MIN_QUALITY
+    max_quality = MAX_QUALITY
+    step = QUALITY_STEP
+    
+    def snap(quality):
+        return min_quality + round((quality - min_quality) / step) * step
+    
+    def predict(quality, size_kb):
+        # WebP size grows roughly with the square of quality, so extrapolate
+        # from a measurement to the quality that should just fit
+        return snap(quality * (target_kb / size_kb) ** 0.5)
+    
+    # Qualities in [lo, hi] are still undecided; everything below lo is known
+    # to fit and everything above hi is known to be too large.
+    lo, hi = min_quality, max_quality
+    
+    # `curve` maps quality to size_kb as measured on these exact pixels in
+    # earlier runs, which already narrows the search for a new target. It is
+    # shared with workers compressing identical uploads, so read a snapshot.
+    points = dict(curve)
+    known_lo = max([q for q, size_kb in points.items() if size_kb <= target_kb], default=min_quality)
+    known_hi = min([q - step for q, size_kb in points.items() if size_kb > target_kb], default=max_quality)
+    if known_hi < min_quality:
+        # Nothing fits: only the lowest quality fallback needs encoding
+        lo = hi = min_quality
+    elif known_lo <= known_hi:
+        lo, hi = known_lo, known_hi
+    
+    if points:
+        # Start from the measurement closest to the new target
+        quality, size_kb = min(points.items(), key=lambda point: abs(point[1] - target_kb))
+        quality = predict(quality, size_kb)
+        stage = "guess"
+    else:
+        quality = 50
+        stage = "probe"
+    quality = min(max(quality, lo), hi)
+    
+    # Encode into a scratch buffer and swap it with the kept one on success,
+    # so the buffers are reused and the payload is only copied out once.
+    buffer, best_buffer = BytesIO(), BytesIO()
+    best = None
+    while lo <= hi:
+        buffer.seek(0)
+        buffer.truncate(0)
+        encode(buffer, quality)
         size_kb = buffer.tell() / 1024
-        if size_kb <= target_kb:
-            break
-        quality -= step
-    buffer.seek(0)
-    return buffer.getvalue(), size_kb, quality
+        curve[quality] = size_kb
+        fits = size_kb <= target_kb
+        if fits:
+            best = (size_kb, quality)
+            buffer, best_buffer = best_buffer, buffer
+            lo = quality + step
+        else:
+            smallest = (size_kb, quality)
+            hi = quality - step
+        
+        if stage == "probe":
+            quality = predict(quality, size_kb)
+            stage = "guess"
+        elif stage == "guess":
+            # Confirm the guess by trying the neighbouring step
+            quality = lo if fits else hi
+            stage = "bisect"
+        else:
+            # The guess was off by more than a step: binary search the rest
+            quality = lo + (hi - lo) // step // 2 * step
+        quality = min(max(quality, lo), hi)
+    
+    if best is None:
+        # Nothing fits the target: fall back to the last (lowest quality) attempt
+        size_kb, quality = smallest
+        return buffer.getvalue(), size_kb, quality
+    size_kb, quality = best
+    return best_buffer.getvalue(), size_kb, quality
+
+def fits_at_lowest_quality(encode, target_kb, curve):
+    if MIN_QUALITY not in curve:
+        buffer = BytesIO()
+        encode(buffer, MIN_QUALITY)
+        curve[MIN_QUALITY] = buffer.tell() / 1024
+    return curve[MIN_QUALITY] <= target_kb
+
+def compress_image(img, target_kb, method=4, curves=None, dimensions=None):
+    if curves is None:
+        curves = {}
+    
+    # Reads `img` at call time, so it also encodes the resized image below
+    def encode(buffer, quality):
+        img.save(buffer, format="WEBP", quality=quality, method=method)
+    
+    # Callers pass `dimensions` when the image is already known not to fit
+    if dimensions is None:
+        dimensions = max_dimensions(img.size, target_kb)
+        if dimensions is not None and fits_at_lowest_quality(encode, target_kb, curves.setdefault(img.size, {})):
+            dimensions = None
+    if dimensions is not None:
+        img = img.resize(dimensions, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    
+    return search_quality(encode, target_kb, curves.setdefault(img.size, {}))
+
+def compress_image_vips(raw, target_kb, method=4, curves=None):
+    if curves is None:
+        curves = {}
+    
+    def decode(image):
+        # flatten() takes the background in the image's own units, so bring
+        # 16-bit PNGs and other non-8-bit inputs down to 8-bit sRGB first
+        if image.format != "uchar":
+            image = image.colourspace("srgb")
+        if image.hasalpha():
+            image = image.flatten(background=255)
+        # Decode, resize and flatten stream through in a single pass, leaving
+        # one final pixel buffer that each encode in the search reads from
+        return image.copy_memory()
+    
+    # libvips copies EXIF (often with an embedded thumbnail), ICC and XMP into
+    # the output by default. The Pillow path writes none of it, so strip it
+    # here too and spend the whole size budget on pixels.
+    if pyvips.at_least_libvips(8, 15):
+        save_options = {"keep": pyvips.enums.ForeignKeep.NONE}
+    else:
+        save_options = {"strip": True}
+    
+    # Reads `image` at call time, so it also encodes the shrunk image below
+    def encode(buffer, quality):
+        buffer.write(image.write_to_buffer(".webp", Q=quality, effort=method, **save_options))
+    
+    # libvips decodes straight from the uploaded bytes, skipping Pillow. Only
+    # the header is read here; pixels are decoded in decode().
+    image = pyvips.Image.new_from_buffer(raw, "", access="sequential")
+    dimensions = max_dimensions((image.width, image.height), target_kb)
+    full_curve = curves.setdefault((image.width, image.height), {})
+    # Skip the full-size decode when an earlier run showed it cannot fit
+    if dimensions is None or full_curve.get(MIN_QUALITY, 0) <= target_kb:
+        image = decode(image)
+        if dimensions is not None and fits_at_lowest_quality(encode, target_kb, full_curve):
+            dimensions = None
+    if dimensions is not None:
+        # Shrink-on-load: JPEG and WebP decode straight at a reduced scale
+        image = decode(pyvips.Image.thumbnail_buffer(
+            raw, dimensions[0], height=dimensions[1], size="down", no_rotate=True
+        ))
+    
+    return search_quality(encode, target_kb, curves.setdefault((image.width, image.height), {}))
+
+def compress_file(filename, read_bytes, target_kb, method, quality_curves):
+    # Workers get a reader rather than the bytes themselves, so inflating ZIP
+    # entries happens here in parallel instead of on the main thread
+    raw = read_bytes()
+    original_size = len(raw) / 1024  # KB
+    
+    # Encoder measurements from earlier runs on this exact image, so changing
+    # the target and compressing again usually takes a single encode. Sizes
+    # only carry over between runs that encode the same dimensions, so the
+    # curves are further keyed by the encoded size.
+    curves = quality_curves.setdefault((hashlib.blake2b(raw, digest_size=8).digest(), method), {})
+    
+    if pyvips is not None:
+        compressed_data, final_size, quality = compress_image_vips(raw, target_kb, method, curves)
+    else:
+        img = Image.open(BytesIO(raw))
+        
+        shrink_to = None
+        if img.format == 'JPEG':
+            dimensions = max_dimensions(img.size, target_kb)
+            if dimensions is not None and curves.get(img.size, {}).get(MIN_QUALITY, 0) > target_kb:
+                # An earlier run showed the full-size image cannot fit, so let
+                # libjpeg decode at 1/2, 1/4 or 1/8 scale straight away. The
+                # drafted size is only a lower bound, so still resize to the
+                # same dimensions the first run ended up with.
+                img.draft('RGB', dimensions)
+                shrink_to = dimensions
+        
+        # Most JPEGs are already RGB here and need no extra pixel buffer
+        if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+            img = flatten_alpha(img)
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+        compressed_data, final_size, quality = compress_image(img, target_kb, method, curves, shrink_to)
+    
+    return filename, compressed_data, original_size, final_size
+
+def add_to_zip(zip_file, filename, data, date_time):
+    zip_info = zipfile.ZipInfo(f"compressed_{PurePosixPath(filename).stem}.webp", date_time=date_time)
+    # WebP data is already entropy coded, so deflating it only burns CPU
+    zip_info.compress_type = zipfile.ZIP_STORED
+    zip_file.writestr(zip_info, data)
 
-def create_download_zip(compressed_files):
+def compress_all(jobs, total_files, target_kb, method, progress_bar, status_text):
+    results = [None] * total_files
+    settled = [False] * total_files
+    max_workers = os.cpu_count() or 1
+    # Only queue a couple of jobs per worker so huge batches stay lazy
+    max_in_flight = 2 * max_workers
+    jobs = enumerate(jobs)
+    # Plain dict shared with the workers; single dict updates are atomic
+    quality_curves = st.session_state.quality_curves
+    
+    # The download archive is filled as results arrive, so it is ready as
+    # soon as the last image is done
     zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for filename, data, _, _ in compressed_files:
-            zip_file.writestr(f"compressed_{filename.split('.')[0]}.webp", data)
-    return zip_buffer.getvalue()
+    date_time = time.localtime()[:6]
+    
+    # Pillow and libvips release the GIL while decoding and encoding, so
+    # threads scale across cores without pickling image data into processes.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        pending = {}
+        done = 0
+        last_update = 0.0
+        next_entry = 0
+        while True:
+            for i, (filename, read_bytes) in islice(jobs, max_in_flight - len(pending)):
+                future = executor.submit(compress_file, filename, read_bytes, target_kb, method, quality_curves)
+                pending[future] = (i, filename)
+            if not pending:
+                break
+            
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, filename = pending.pop(future)
+                done += 1
+                
+                # Each UI update is a message to the browser; cap them at ~20/s
+                now = time.monotonic()
+                if now - last_update > 0.05 or done == total_files:
+                    status_text.text(f"Processed file {done}/{total_files}: {filename}")
+                    progress_bar.progress(done / total_files)
+                    last_update = now
+                
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    st.error(f"Error processing {filename}: {e}")
+                settled[i] = True
+                
+                # Add entries in upload order, each as soon as all earlier
+                # images are done, so the archive matches the results list
+                while next_entry < total_files and settled[next_entry]:
+                    if results[next_entry] is not None:
+                        entry_name, entry_data, _, _ = results[next_entry]
+                        add_to_zip(zip_file, entry_name, entry_data, date_time)
+                    next_entry += 1
+    
+    # Keep upload order regardless of which image finished first
+    compressed_files = [result for result in results if result is not None]
+    return compressed_files, zip_buffer.getvalue()
 
 def main():
     st.markdown('<h1 class="main-header">Smart Image Compressor</h1>', unsafe_allow_html=True)
@@ -49,6 +321,10 @@ def main():
     # Initialize session state for compressed files
     if 'compressed_files' not in st.session_state:
         st.session_state.compressed_files = None
+    if 'zip_data' not in st.session_state:
+        st.session_state.zip_data = None
+    if 'quality_curves' not in st.session_state:
+        st.session_state.quality_curves = {}
     
     with st.expander("ℹ️ About this app", expanded=False):
         st.markdown("""
@@ -102,6 +378,13 @@ def main():
             value=45,
             help="Maximum file size for each compressed image"
         )
+        method = st.slider(
+            "Encoding Effort:", 
+            min_value=0, 
+            max_value=6, 
+            value=4,
+            help="Higher values spend more CPU time to get better quality at the same size"
+        )
     
     st.markdown('</div>', unsafe_allow_html=True)
     
@@ -117,9 +400,13 @@ def main():
                 status_text = st.empty()
                 
                 if selection_type == "Files" and uploaded_files:
-                    st.session_state.compressed_files = process_files(uploaded_files, target_kb, progress_bar, status_text)
+                    compressed_files, zip_data = process_files(uploaded_files, target_kb, method, progress_bar, status_text)
                 else:
-                    st.session_state.compressed_files = process_zip(uploaded_zip, target_kb, progress_bar, status_text)
+                    compressed_files, zip_data = process_zip(uploaded_zip, target_kb, method, progress_bar, status_text)
+                
+                # Keep the archive alongside the files so reruns don't rebuild it
+                st.session_state.compressed_files = compressed_files
+                st.session_state.zip_data = zip_data
                 
                 progress_bar.progress(100)
                 status_text.success("✅ Compression complete!")
@@ -129,80 +416,37 @@ def main():
             st.error("Please upload files or a ZIP archive before compressing.")
     
     if st.session_state.compressed_files:
-        display_results(st.session_state.compressed_files)
+        display_results(st.session_state.compressed_files, st.session_state.zip_data)
 
-def process_files(uploaded_files, target_kb, progress_bar, status_text):
-    compressed_files = []
-    total_files = len(uploaded_files)
-    
-    for i, uploaded_file in enumerate(uploaded_files):
-        status_text.text(f"Processing file {i+1}/{total_files}: {uploaded_file.name}")
-        progress_bar.progress((i) / total_files)
-        
-        time.sleep(0.1)
-        
-        try:
-            img = Image.open(uploaded_file)
-            original_size = uploaded_file.size / 1024  # KB
-            
-            if img.mode in ('RGBA', 'LA'):
-                img = img.convert('RGB')
-                
-            compressed_data, final_size, quality = compress_image(img, target_kb)
-            compressed_files.append((uploaded_file.name, compressed_data, original_size, final_size))
-            
-        except Exception as e:
-            st.error(f"Error processing {uploaded_file.name}: {e}")
-    
-    return compressed_files
+def process_files(uploaded_files, target_kb, method, progress_bar, status_text):
+    jobs = ((uploaded_file.name, uploaded_file.getvalue) for uploaded_file in uploaded_files)
+    return compress_all(jobs, len(uploaded_files), target_kb, method, progress_bar, status_text)
 
-def process_zip(uploaded_zip, target_kb, progress_bar, status_text):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        zip_path = os.path.join(temp_dir, "uploaded.zip")
-        with open(zip_path, "wb") as f:
-            f.write(uploaded_zip.getvalue())
-        
-        status_text.text("Extracting ZIP file...")
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        image_files = []
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                if file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                    image_files.append((file, os.path.join(root, file)))
-        
-        total_files = len(image_files)
+def process_zip(uploaded_zip, target_kb, method, progress_bar, status_text):
+    status_text.text("Reading ZIP file...")
+    # The upload is already an in-memory file object, so read the archive
+    # from it directly instead of copying it anywhere first
+    with zipfile.ZipFile(uploaded_zip, 'r') as zip_ref:
+        image_infos = [
+            info for info in zip_ref.infolist()
+            if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in IMAGE_EXTENSIONS
+        ]
+        total_files = len(image_infos)
         status_text.text(f"Found {total_files} images in ZIP file")
         
-        compressed_files = []
-        for i, (filename, file_path) in enumerate(image_files):
-            status_text.text(f"Processing file {i+1}/{total_files}: {filename}")
-            progress_bar.progress((i) / total_files)
-            
-            time.sleep(0.1)
-            
-            try:
-                img = Image.open(file_path)
-                original_size = os.path.getsize(file_path) / 1024  # KB
-                
-                if img.mode in ('RGBA', 'LA'):
-                    img = img.convert('RGB')
-                    
-                compressed_data, final_size, quality = compress_image(img, target_kb)
-                compressed_files.append((filename, compressed_data, original_size, final_size))
-                
-            except Exception as e:
-                st.error(f"Error processing {filename}: {e}")
-    
-    return compressed_files
+        # ZipFile serializes seeks on the shared archive, so workers can read
+        # and decompress their own entries concurrently
+        jobs = ((os.path.basename(info.filename), partial(zip_ref.read, info)) for info in image_infos)
+        return compress_all(jobs, total_files, target_kb, method, progress_bar, status_text)
 
-def display_results(compressed_files):
+def display_results(compressed_files, zip_data):
     st.markdown('<div class="card">', unsafe_allow_html=True)
     st.markdown('<h3><span class="step-number">4</span> Download Results</h3>', unsafe_allow_html=True)
     
-    total_original = sum(original_size for _, _, original_size, _ in compressed_files)
-    total_compressed = sum(final_size for _, _, _, final_size in compressed_files)
+    total_original = total_compressed = 0
+    for _, _, original_size, final_size in compressed_files:
+        total_original += original_size
+        total_compressed += final_size
     savings = ((total_original - total_compressed) / total_original * 100) if total_original > 0 else 0
     
     st.markdown(f"""
@@ -217,7 +461,6 @@ def display_results(compressed_files):
     </div>
     """, unsafe_allow_html=True)
     
-    zip_data = create_download_zip(compressed_files)
     st.download_button(
         label="📦 Download All as ZIP",
         data=zip_data,
@@ -266,7 +509,7 @@ def display_results(compressed_files):
                     st.download_button(
                         label=f"⬇️ Download",
                         data=compressed_data,
-                        file_name=f"compressed_{filename.split('.')[0]}.webp",
+                        file_name=f"compressed_{PurePosixPath(filename).stem}.webp",
                         mime="image/webp",
                         use_container_width=True,
                         key=f"btn_{i}"
@@ -288,7 +531,7 @@ def display_results(compressed_files):
                     st.download_button(
                         label="⬇️",
                         data=compressed_data,
-                        file_name=f"compressed_{filename.split('.')[0]}.webp",
+                        file_name=f"compressed_{PurePosixPath(filename).stem}.webp",
                         mime="image/webp",
                         key=f"list_btn_{i}"
                     )